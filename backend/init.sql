@@ -12,8 +12,13 @@ CREATE TABLE IF NOT EXISTS tasks (
     embedding vector(384) -- 384 dimensions for all-MiniLM-L6-v2 model
 );
 
--- Create index for vector similarity search
-CREATE INDEX IF NOT EXISTS tasks_embedding_idx ON tasks USING ivfflat (embedding vector_cosine_ops);
+-- Create HNSW index for similarity search. Embeddings are stored
+-- L2-normalized, so inner product ranks the same as cosine similarity.
+-- Partial so rows without an embedding stay out of the graph and
+-- vector_search's filter matches it.
+CREATE INDEX IF NOT EXISTS tasks_embedding_hnsw ON tasks
+    USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64)
+    WHERE embedding IS NOT NULL;
 
 -- Insert sample data
 INSERT INTO tasks (title, description, status) VALUES
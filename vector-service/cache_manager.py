@@ -1,10 +1,147 @@
 import redis
 import json
-import hashlib
+import logging
+import xxhash
+import orjson
 import numpy as np
-import pickle
+import struct
 import os
-from typing import Optional, List, Dict, Any
+import threading
+from collections import Counter, OrderedDict
+from typing import Optional, List, Dict, Any, Iterable, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Bound once at import; the cache-key path runs on every lookup
+_XXH = xxhash.xxh3_64_hexdigest
+
+# Embeddings are stored as a small fixed header (encoding, pad, dimension)
+# followed by the raw little-endian vector bytes. Int8 payloads carry a
+# float32 scale right after the header. The pad byte keeps the float
+# payload 4-byte aligned, so zero-copy views over it stay on fast paths.
+_EMBEDDING_HEADER = struct.Struct('<BxH')
+_INT8_SCALE = struct.Struct('<f')
+_FLOAT32 = 3
+_INT8 = 4
+# Encodings written with the old unpadded 3-byte header; read as misses
+# until they expire
+_LEGACY_ENCODINGS = (1, 2)
+
+# Query and task (document) embeddings live in separate namespaces with
+# their own TTLs, so a burst of one-off queries cannot push out the
+# expensive-to-recompute task embeddings
+QUERY_EMBEDDING_PREFIX = "emb:q"
+DOC_EMBEDDING_PREFIX = "emb:doc"
+SEARCH_PREFIX = "search"
+QUERY_EMBEDDING_TTL = int(os.getenv('QUERY_EMBEDDING_TTL', 300))
+DOC_EMBEDDING_TTL = int(os.getenv('DOC_EMBEDDING_TTL', 86400))
+_EMBEDDING_TTLS = {
+    QUERY_EMBEDDING_PREFIX: QUERY_EMBEDDING_TTL,
+    DOC_EMBEDDING_PREFIX: DOC_EMBEDDING_TTL,
+}
+
+# Keys per SETEX pipeline, bounding work per Redis round trip
+_WRITE_CHUNK_SIZE = 500
+
+# Search keys embed this counter; invalidating bumps it so every older
+# entry is unreachable at once and ages out through its TTL
+_SEARCH_GENERATION_KEY = f"stats:{SEARCH_PREFIX}:gen"
+
+# Write counters maintained alongside each SETEX so stats never scan the
+# keyspace. They count writes, not live entries: overwrites, TTL expiry and
+# eviction are not reflected.
+def _writes_key(prefix: str) -> str:
+    return f"stats:{prefix}:writes"
+
+def _stable_filters_bytes(filters: Optional[Dict]) -> bytes:
+    """Order-independent encoding of search filters for cache keys"""
+    if not filters:
+        return b""
+    # JSON escapes keys and values, and OPT_SORT_KEYS sorts nested dicts too
+    return orjson.dumps(filters, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+
+# Hit/miss counts are accumulated in-process and flushed to Redis every
+# this many lookups, so tracking adds no round trip to the lookup itself
+_STATS_FLUSH_INTERVAL = int(os.getenv('CACHE_STATS_FLUSH_INTERVAL', 100))
+_HIT_MISS_STATS = ("emb:hits", "emb:misses", "search:hits", "search:misses")
+
+def _hit_rate(hits: int, misses: int):
+    lookups = hits + misses
+    return round(hits / lookups, 4) if lookups else "N/A"
+
+def _serialize_embedding(embedding: np.ndarray, quantize: bool = True) -> bytes:
+    """Pack an embedding into its Redis wire format"""
+    vector = np.asarray(embedding, dtype='<f4')
+    if not quantize:
+        return _EMBEDDING_HEADER.pack(_FLOAT32, vector.shape[0]) + vector.tobytes()
+
+    # Symmetric per-vector int8 quantization keeps cosine similarity
+    # practically unchanged at a quarter of the size
+    peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    quantized = np.round(vector / scale).astype(np.int8)
+    return (_EMBEDDING_HEADER.pack(_INT8, vector.shape[0])
+            + _INT8_SCALE.pack(scale) + quantized.tobytes())
+
+def _deserialize_embedding(payload: bytes,
+                           allow_quantized: bool = True) -> Optional[np.ndarray]:
+    """Unpack an embedding from its Redis wire format (read-only result)
+
+    Returns None for an int8 payload when allow_quantized is False, and
+    for payloads in a legacy encoding.
+    """
+    encoding, dim = _EMBEDDING_HEADER.unpack_from(payload)
+    if encoding in _LEGACY_ENCODINGS:
+        return None
+    if encoding == _FLOAT32:
+        # Zero-copy view over the Redis payload; callers that need to
+        # mutate it must .copy() first
+        return np.frombuffer(payload, dtype='<f4', count=dim,
+                             offset=_EMBEDDING_HEADER.size)
+    if encoding == _INT8:
+        if not allow_quantized:
+            return None
+        scale, = _INT8_SCALE.unpack_from(payload, _EMBEDDING_HEADER.size)
+        quantized = np.frombuffer(payload, dtype=np.int8, count=dim,
+                                  offset=_EMBEDDING_HEADER.size + _INT8_SCALE.size)
+        # Dequantize straight into a single float32 output buffer
+        embedding = np.multiply(quantized, np.float32(scale), dtype=np.float32)
+        embedding.flags.writeable = False
+        return embedding
+    raise ValueError(f"Unknown embedding encoding: {encoding}")
+
+class _LocalEmbeddingCache:
+    """Bounded in-process LRU for hot embeddings, keyed by Redis cache key"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        if self.maxsize <= 0:
+            return
+        # Entries are shared between callers, so keep them read-only.
+        # Read-only float32 arrays (e.g. fresh from Redis) are stored as-is.
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.flags.writeable:
+            vector = vector.copy()
+            vector.flags.writeable = False
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
 class VectorCacheManager:
     def __init__(self):
@@ -13,73 +150,240 @@ class VectorCacheManager:
             port=int(os.getenv('REDIS_PORT', 6379)),
             decode_responses=False  # We'll handle binary data
         )
+        # Store query embeddings as int8 + scale rather than full float32.
+        # Task embeddings are always stored exactly: update_all_embeddings
+        # writes cache hits to Postgres, so they must stay lossless and
+        # unit-norm.
+        self.quantize = os.getenv('EMBEDDING_CACHE_QUANTIZE', 'true').lower() == 'true'
+        # Hot embeddings are served from process memory before Redis
+        self.local_cache = _LocalEmbeddingCache(
+            int(os.getenv('EMBEDDING_LOCAL_CACHE_SIZE', 4096))
+        )
+        self._pending_stats = Counter()
+        self._stats_lock = threading.Lock()
         
         # Test connection
         try:
             self.redis_client.ping()
-            print("Connected to Redis for vector caching")
+            logger.info("Connected to Redis for vector caching")
         except redis.ConnectionError:
-            print("Failed to connect to Redis")
+            logger.warning("Failed to connect to Redis")
             self.redis_client = None
     
-    def _generate_cache_key(self, text: str, prefix: str = "embedding") -> str:
-        """Generate a cache key based on text content"""
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        return f"{prefix}:{text_hash}"
+    def _record(self, stat: str, count: int = 1):
+        """Count a cache hit or miss, flushing to Redis every few lookups"""
+        if count <= 0:
+            return
+        with self._stats_lock:
+            self._pending_stats[stat] += count
+            flush = sum(self._pending_stats.values()) >= _STATS_FLUSH_INTERVAL
+        if flush:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        """Push locally accumulated hit/miss counts to Redis"""
+        with self._stats_lock:
+            pending, self._pending_stats = self._pending_stats, Counter()
+        if not pending or not self.redis_client:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for stat, count in pending.items():
+                pipe.incrby(f"stats:{stat}", count)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Error flushing cache stats: %s", e)
+
+    def _quantize_for(self, prefix: str) -> bool:
+        """Whether embeddings in this namespace are stored as int8"""
+        return self.quantize and prefix != DOC_EMBEDDING_PREFIX
+
+    def _generate_cache_key(self, text: Union[str, bytes],
+                            prefix: str = DOC_EMBEDDING_PREFIX) -> str:
+        """Generate a cache key based on text content (str or bytes)"""
+        # xxhash >= 4 only hashes bytes, so encode str input explicitly
+        if isinstance(text, str):
+            text = text.encode()
+        return prefix + ":" + _XXH(text)
+    
+    def _search_cache_key(self, query: str, filters: Dict = None) -> str:
+        """Generate a search cache key from the query, its filters and the
+        current search cache generation"""
+        # Hash the parts directly rather than hashing a sorted JSON dump;
+        # the length prefix keeps a '|' inside the query from colliding
+        encoded_query = query.encode()
+        hasher = xxhash.xxh3_64()
+        hasher.update(b"%d|" % len(encoded_query))
+        hasher.update(encoded_query)
+        hasher.update(_stable_filters_bytes(filters))
+        generation = int(self.redis_client.get(_SEARCH_GENERATION_KEY) or 0)
+        return f"{SEARCH_PREFIX}:{generation}:{hasher.hexdigest()}"
     
-    def get_embedding(self, text: str) -> Optional[np.ndarray]:
+    def get_embedding(self, text: str,
+                      prefix: str = DOC_EMBEDDING_PREFIX) -> Optional[np.ndarray]:
         """Get cached embedding for text"""
+        key = self._generate_cache_key(text, prefix)
+        embedding = self.local_cache.get(key)
+        if embedding is not None:
+            self._record("emb:hits")
+            return embedding
+
         if not self.redis_client:
+            self._record("emb:misses")
             return None
             
         try:
-            key = self._generate_cache_key(text)
             cached = self.redis_client.get(key)
             
-            if cached:
-                embedding = pickle.loads(cached)
-                print(f"Cache hit for embedding: {text[:50]}...")
+            # Stale int8 entries in the task namespace count as misses
+            embedding = _deserialize_embedding(
+                cached, prefix != DOC_EMBEDDING_PREFIX
+            ) if cached else None
+            if embedding is not None:
+                self.local_cache.put(key, embedding)
+                self._record("emb:hits")
+                logger.debug("Cache hit for embedding: %.50s...", text)
                 return embedding
                 
         except Exception as e:
-            print(f"Error getting cached embedding: {e}")
+            logger.warning("Error getting cached embedding: %s", e)
             
+        self._record("emb:misses")
         return None
     
-    def set_embedding(self, text: str, embedding: np.ndarray, ttl: int = 3600):
-        """Cache embedding for text (1 hour default TTL)"""
+    def set_embedding(self, text: str, embedding: np.ndarray, ttl: int = None,
+                      prefix: str = DOC_EMBEDDING_PREFIX):
+        """Cache embedding for text (namespace TTL by default)"""
+        if ttl is None:
+            ttl = _EMBEDDING_TTLS.get(prefix, DOC_EMBEDDING_TTL)
+        key = self._generate_cache_key(text, prefix)
+        self.local_cache.put(key, embedding)
+
         if not self.redis_client:
             return
             
         try:
-            key = self._generate_cache_key(text)
-            serialized = pickle.dumps(embedding)
-            self.redis_client.setex(key, ttl, serialized)
-            print(f"Cached embedding for: {text[:50]}...")
+            serialized = _serialize_embedding(embedding, self._quantize_for(prefix))
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.setex(key, ttl, serialized)
+            pipe.incr(_writes_key(prefix))
+            pipe.execute()
+            logger.debug("Cached embedding for: %.50s...", text)
             
         except Exception as e:
-            print(f"Error caching embedding: {e}")
-    
+            logger.warning("Error caching embedding: %s", e)
+
+    def get_query_embedding(self, text: str) -> Optional[np.ndarray]:
+        """Get cached embedding for a search query"""
+        return self.get_embedding(text, QUERY_EMBEDDING_PREFIX)
+
+    def set_query_embedding(self, text: str, embedding: np.ndarray):
+        """Cache embedding for a search query (short TTL)"""
+        self.set_embedding(text, embedding, QUERY_EMBEDDING_TTL, QUERY_EMBEDDING_PREFIX)
+
+    def get_doc_embedding(self, text: str) -> Optional[np.ndarray]:
+        """Get cached embedding for task text"""
+        return self.get_embedding(text, DOC_EMBEDDING_PREFIX)
+
+    def set_doc_embedding(self, text: str, embedding: np.ndarray):
+        """Cache embedding for task text (long TTL)"""
+        self.set_embedding(text, embedding, DOC_EMBEDDING_TTL, DOC_EMBEDDING_PREFIX)
+
+    def mget_embeddings(self, texts: List[str],
+                        prefix: str = DOC_EMBEDDING_PREFIX) -> List[Optional[np.ndarray]]:
+        """Get cached embeddings for many texts in a single round trip"""
+        keys = [self._generate_cache_key(text, prefix) for text in texts]
+        embeddings = [self.local_cache.get(key) for key in keys]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not self.redis_client or not misses:
+            self._record("emb:hits", len(texts) - len(misses))
+            self._record("emb:misses", len(misses))
+            return embeddings
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for i in misses:
+                pipe.get(keys[i])
+            cached = pipe.execute()
+
+            # Stale int8 entries in the task namespace count as misses
+            allow_quantized = prefix != DOC_EMBEDDING_PREFIX
+            for i, payload in zip(misses, cached):
+                if payload:
+                    embeddings[i] = _deserialize_embedding(payload, allow_quantized)
+                    if embeddings[i] is not None:
+                        self.local_cache.put(keys[i], embeddings[i])
+
+        except Exception as e:
+            logger.warning("Error getting cached embeddings: %s", e)
+
+        hits = sum(e is not None for e in embeddings)
+        self._record("emb:hits", hits)
+        self._record("emb:misses", len(texts) - hits)
+        logger.debug("Cache hits for %d/%d embeddings", hits, len(texts))
+        return embeddings
+
+    def mset_embeddings(self, items: List[Tuple[str, np.ndarray]], ttl: int = None,
+                        prefix: str = DOC_EMBEDDING_PREFIX):
+        """Cache many (text, embedding) pairs; the write-side mget_embeddings"""
+        self.set_embeddings_bulk(items, ttl, prefix)
+
+    def set_embeddings_bulk(self, items: Iterable[Tuple[str, np.ndarray]],
+                            ttl: int = None, prefix: str = DOC_EMBEDDING_PREFIX):
+        """Cache (text, embedding) pairs, one pipeline round trip per chunk"""
+        if ttl is None:
+            ttl = _EMBEDDING_TTLS.get(prefix, DOC_EMBEDDING_TTL)
+        quantize = self._quantize_for(prefix)
+        pipe = self.redis_client.pipeline(transaction=False) if self.redis_client else None
+        pending = 0
+        written = 0
+
+        try:
+            for text, embedding in items:
+                key = self._generate_cache_key(text, prefix)
+                self.local_cache.put(key, embedding)
+                if pipe is None:
+                    continue
+
+                pipe.setex(key, ttl, _serialize_embedding(embedding, quantize))
+                pending += 1
+                # Execute in chunks to bound the memory held by the pipeline
+                if pending >= _WRITE_CHUNK_SIZE:
+                    pipe.incrby(_writes_key(prefix), pending)
+                    pipe.execute()
+                    written += pending
+                    pending = 0
+
+            if pending:
+                pipe.incrby(_writes_key(prefix), pending)
+                pipe.execute()
+                written += pending
+            if written:
+                logger.debug("Cached %d embeddings", written)
+
+        except Exception as e:
+            logger.warning("Error caching embeddings: %s", e)
+
     def get_search_results(self, query: str, filters: Dict = None) -> Optional[List[Dict]]:
         """Get cached search results"""
         if not self.redis_client:
             return None
             
         try:
-            # Include filters in cache key
-            cache_data = {"query": query, "filters": filters or {}}
-            cache_str = json.dumps(cache_data, sort_keys=True)
-            key = self._generate_cache_key(cache_str, "search")
+            key = self._search_cache_key(query, filters)
             
             cached = self.redis_client.get(key)
             if cached:
                 results = json.loads(cached.decode())
-                print(f"Cache hit for search: {query[:50]}...")
+                self._record("search:hits")
+                logger.debug("Cache hit for search: %.50s...", query)
                 return results
                 
         except Exception as e:
-            print(f"Error getting cached search results: {e}")
+            logger.warning("Error getting cached search results: %s", e)
             
+        self._record("search:misses")
         return None
     
     def set_search_results(self, query: str, results: List[Dict], 
@@ -89,16 +393,17 @@ class VectorCacheManager:
             return
             
         try:
-            cache_data = {"query": query, "filters": filters or {}}
-            cache_str = json.dumps(cache_data, sort_keys=True)
-            key = self._generate_cache_key(cache_str, "search")
+            key = self._search_cache_key(query, filters)
             
             serialized = json.dumps(results).encode()
-            self.redis_client.setex(key, ttl, serialized)
-            print(f"Cached search results for: {query[:50]}...")
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.setex(key, ttl, serialized)
+            pipe.incr(_writes_key(SEARCH_PREFIX))
+            pipe.execute()
+            logger.debug("Cached search results for: %.50s...", query)
             
         except Exception as e:
-            print(f"Error caching search results: {e}")
+            logger.warning("Error caching search results: %s", e)
     
     def invalidate_search_cache(self):
         """Clear all search cache"""
@@ -106,13 +411,13 @@ class VectorCacheManager:
             return
             
         try:
-            keys = self.redis_client.keys("search:*")
-            if keys:
-                self.redis_client.delete(*keys)
-                print(f"Cleared {len(keys)} search cache entries")
+            # One INCR instead of walking the keyspace; entries from older
+            # generations are never read again and expire on their TTL
+            generation = self.redis_client.incr(_SEARCH_GENERATION_KEY)
+            logger.debug("Search cache generation is now %d", generation)
                 
         except Exception as e:
-            print(f"Error clearing search cache: {e}")
+            logger.warning("Error clearing search cache: %s", e)
     
     def get_cache_stats(self) -> Dict[str, Any]:
         """Get cache statistics"""
@@ -120,17 +425,31 @@ class VectorCacheManager:
             return {"status": "disconnected"}
             
         try:
+            self._flush_stats()
             info = self.redis_client.info()
-            embedding_keys = len(self.redis_client.keys("embedding:*"))
-            search_keys = len(self.redis_client.keys("search:*"))
+            (query_writes, doc_writes, search_writes,
+             emb_hits, emb_misses, search_hits, search_misses) = (
+                int(count or 0) for count in self.redis_client.mget(
+                    _writes_key(QUERY_EMBEDDING_PREFIX),
+                    _writes_key(DOC_EMBEDDING_PREFIX),
+                    _writes_key(SEARCH_PREFIX),
+                    *(f"stats:{stat}" for stat in _HIT_MISS_STATS)
+                )
+            )
             
             return {
                 "status": "connected",
                 "total_keys": info.get("db0", {}).get("keys", 0),
-                "embedding_cache_entries": embedding_keys,
-                "search_cache_entries": search_keys,
+                "embedding_cache_writes": query_writes + doc_writes,
+                "query_embedding_cache_writes": query_writes,
+                "doc_embedding_cache_writes": doc_writes,
+                "search_cache_writes": search_writes,
+                "local_cache_entries": len(self.local_cache),
                 "memory_usage": info.get("used_memory_human", "N/A"),
-                "hit_rate": "N/A"  # Would need custom tracking
+                "hit_rate": _hit_rate(emb_hits + search_hits,
+                                      emb_misses + search_misses),
+                "embedding_hit_rate": _hit_rate(emb_hits, emb_misses),
+                "search_hit_rate": _hit_rate(search_hits, search_misses)
             }
             
         except Exception as e:
@@ -0,0 +1,108 @@
+"""
+Embedding model loader for the vector service
+Runs all-MiniLM-L6-v2 through ONNX Runtime with dynamic int8 quantization,
+falling back to the PyTorch SentenceTransformer when the ONNX model or
+runtime is unavailable
+
+The ONNX model is exported at image build time (see Dockerfile); run this
+module directly to export it for local development.
+"""
+
+import os
+import logging
+import numpy as np
+
+MODEL_ID = 'sentence-transformers/all-MiniLM-L6-v2'
+MAX_SEQ_LENGTH = 256  # Same truncation as the SentenceTransformer model
+QUANTIZED_MODEL_FILE = 'model_quantized.onnx'
+DEFAULT_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'onnx-model')
+
+logger = logging.getLogger(__name__)
+
+def export_quantized_model(model_dir):
+    """Export the model to ONNX and quantize it to int8 (build-time step)"""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    logger.info("Exporting %s to ONNX in %s", MODEL_ID, model_dir)
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    # Dynamic quantization: int8 weights, activations quantized at runtime,
+    # which lets ONNX Runtime use VNNI int8 matmuls where the CPU has them
+    config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=model_dir, quantization_config=config)
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(model_dir)
+
+class OnnxSentenceEncoder:
+    """ONNX Runtime replacement for the SentenceTransformer.encode calls we make"""
+
+    def __init__(self, model_dir=DEFAULT_MODEL_DIR):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"No exported ONNX model at {model_path}")
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        logger.info("Loaded quantized ONNX model from %s", model_path)
+
+    def _encode_batch(self, texts, normalize_embeddings):
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=MAX_SEQ_LENGTH,
+            return_tensors='np'
+        )
+        feed = {name: inputs[name].astype(np.int64) for name in self.input_names}
+        token_embeddings = self.session.run(None, feed)[0]
+
+        # Mean pooling over real (non-padding) tokens
+        mask = inputs['attention_mask'][..., np.newaxis].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        embeddings = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.clip(norms, 1e-12, None)
+        return embeddings.astype(np.float32)
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False,
+               convert_to_numpy=True, normalize_embeddings=False):
+        """Embed a string or a list of strings, mirroring SentenceTransformer.encode"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        if not sentences:
+            return np.empty((0, 0), dtype=np.float32)
+
+        # Longest first so each batch is padded only to similar lengths
+        order = np.argsort([-len(s) for s in sentences], kind='stable')
+        batches = [
+            self._encode_batch([sentences[i] for i in order[start:start + batch_size]],
+                               normalize_embeddings)
+            for start in range(0, len(sentences), batch_size)
+        ]
+
+        embeddings = np.empty((len(sentences), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.vstack(batches)
+        return embeddings[0] if single else embeddings
+
+def load_embedding_model():
+    """Load the configured embedding backend ('onnx' or 'torch')"""
+    if os.getenv('EMBEDDING_BACKEND', 'onnx') == 'onnx':
+        try:
+            return OnnxSentenceEncoder(os.getenv('ONNX_MODEL_DIR', DEFAULT_MODEL_DIR))
+        except Exception as e:
+            logger.warning("ONNX model not available (%s), using PyTorch model", e)
+
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer('all-MiniLM-L6-v2')
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    export_quantized_model(os.getenv('ONNX_MODEL_DIR', DEFAULT_MODEL_DIR))
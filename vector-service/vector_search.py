@@ -4,36 +4,162 @@ Vector Search Service for Task Management
 This script generates embeddings for task descriptions and performs similarity search
 """
 
+import io
 import os
 import json
-import psycopg2
+import logging
+import weakref
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import orjson
 from dotenv import load_dotenv
+from cache_manager import cache_manager
+from embedding_model import load_embedding_model
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Texts per model forward pass when embedding in bulk
+ENCODE_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+
+# Bulk embedding updates above this many rows are streamed in with COPY
+COPY_THRESHOLD = int(os.getenv('EMBEDDING_COPY_THRESHOLD', 5000))
+
+# pgvector rejects hnsw.ef_search values outside 1..HNSW_EF_SEARCH_MAX
+HNSW_EF_SEARCH_MAX = 1000
+
+# HNSW candidate list size per search; higher trades speed for recall
+HNSW_EF_SEARCH = min(max(int(os.getenv('HNSW_EF_SEARCH', 40)), 1), HNSW_EF_SEARCH_MAX)
+
+# KNN query prepared once per pooled connection so its plan is reused.
+# Embeddings are unit-normalized, so ranking by inner product (<#>, which
+# returns the negated dot product) equals ranking by cosine similarity.
+# Results come back as a single JSON array (as text, so psycopg2 leaves
+# parsing to orjson) instead of one Python tuple per row.
+VECTOR_SEARCH_STATEMENT = """
+    PREPARE vsearch(vector, int) AS
+    SELECT COALESCE(json_agg(json_build_object(
+               'id', id,
+               'title', title,
+               'description', description,
+               'status', status,
+               'similarity', -distance
+           ) ORDER BY distance), '[]')::text
+    FROM (
+        SELECT id, title, description, status,
+               embedding <#> $1 AS distance
+        FROM tasks
+        WHERE embedding IS NOT NULL
+        ORDER BY distance
+        LIMIT $2
+    ) AS nearest
+"""
+
+# Current rows for a cached ranking. The search cache only holds ids and
+# similarities, so titles, statuses and deletions made by the backend are
+# always read live.
+TASKS_BY_ID_STATEMENT = """
+    PREPARE vtasks(int[]) AS
+    SELECT COALESCE(json_agg(json_build_object(
+               'id', id,
+               'title', title,
+               'description', description,
+               'status', status
+           )), '[]')::text
+    FROM tasks
+    WHERE id = ANY($1)
+"""
+
 class VectorSearchService:
     def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.connection = None
+        self.model = load_embedding_model()
+        self.pool = None
+        # Pooled connections that already have the vector type and
+        # prepared statements set up
+        self._prepared_connections = weakref.WeakSet()
         self.connect_to_db()
     
     def connect_to_db(self):
-        """Connect to PostgreSQL database"""
+        """Create the PostgreSQL connection pool"""
+        # Keep every connection open by default: the pool closes any returned
+        # connection beyond DB_POOL_MIN idle ones, and each replacement has
+        # to redo the vector registration, PREPAREs and SET
+        pool_max = int(os.getenv('DB_POOL_MAX', 16))
         try:
-            self.connection = psycopg2.connect(
+            self.pool = ThreadedConnectionPool(
+                int(os.getenv('DB_POOL_MIN', pool_max)),
+                pool_max,
                 host=os.getenv('DB_HOST', 'localhost'),
                 port=os.getenv('DB_PORT', '5432'),
                 database=os.getenv('DB_NAME', 'taskdb'),
                 user=os.getenv('DB_USER', 'taskuser'),
                 password=os.getenv('DB_PASSWORD', 'taskpass')
             )
-            print("Connected to PostgreSQL database")
+            logger.info("Connected to PostgreSQL database")
         except Exception as e:
-            print(f"Error connecting to database: {e}")
+            logger.error("Error connecting to database: %s", e)
+            raise
+    
+    def _prepare_connection(self, conn):
+        """One-time setup for a connection freshly handed out by the pool"""
+        try:
+            # Bind numpy arrays directly as vector parameters
+            register_vector(conn)
+            with conn.cursor() as cursor:
+                cursor.execute(VECTOR_SEARCH_STATEMENT)
+                cursor.execute(TASKS_BY_ID_STATEMENT)
+                # Session default, so most searches need no per-query SET
+                cursor.execute("SET hnsw.ef_search = %s", (HNSW_EF_SEARCH,))
+            conn.commit()
+        except Exception:
+            # ROLLBACK does not undo PREPARE, so a half-prepared connection
+            # would fail every retry on "already exists"; discard it instead
+            conn.close()
             raise
+        self._prepared_connections.add(conn)
+    
+    @contextmanager
+    def _cursor(self, autocommit=False):
+        """Borrow a pooled connection; commit on success, roll back on error
+
+        With autocommit=True each execute runs on its own, skipping the
+        separate BEGIN and COMMIT round trips; use it for single-statement reads.
+        """
+        conn = self.pool.getconn()
+        try:
+            if conn not in self._prepared_connections:
+                self._prepare_connection(conn)
+            conn.autocommit = autocommit
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            # A dropped connection cannot be rolled back, and trying would
+            # replace the original error with "connection already closed"
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    conn.close()
+            raise
+        finally:
+            self._release_connection(conn)
+    
+    def _release_connection(self, conn):
+        """Hand a connection back to the pool, discarding it if it is dead"""
+        if not conn.closed:
+            try:
+                conn.autocommit = False
+            except Exception:
+                conn.close()
+        # Closed connections must still be returned, or the pool counts
+        # them as in use forever and eventually refuses to hand any out
+        self.pool.putconn(conn, close=bool(conn.closed))
     
     def generate_embedding(self, text):
         """Generate embedding for given text"""
@@ -41,11 +167,30 @@ class VectorSearchService:
             return None
         
         try:
-            embedding = self.model.encode(text)
-            return embedding.tolist()
+            return self.model.encode(text, normalize_embeddings=True)
         except Exception as e:
-            print(f"Error generating embedding: {e}")
+            logger.error("Error generating embedding: %s", e)
             return None
+
+    def generate_embeddings(self, texts):
+        """Generate embeddings for many texts in batched model calls"""
+        if not texts:
+            return []
+
+        try:
+            # encode() sorts by length internally, so each batch is padded
+            # only to its own longest text
+            embeddings = self.model.encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+            return list(embeddings)
+        except Exception as e:
+            logger.error("Error generating embeddings: %s", e)
+            return [None] * len(texts)
     
     def update_task_embedding(self, task_id, description):
         """Update embedding for a specific task"""
@@ -53,97 +198,174 @@ class VectorSearchService:
             return False
         
         embedding = self.generate_embedding(description)
-        if not embedding:
+        if embedding is None:
             return False
         
         try:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                "UPDATE tasks SET embedding = %s WHERE id = %s",
-                (embedding, task_id)
-            )
-            self.connection.commit()
-            cursor.close()
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "UPDATE tasks SET embedding = %s WHERE id = %s",
+                    (embedding, task_id)
+                )
+            cache_manager.invalidate_search_cache()
             return True
         except Exception as e:
-            print(f"Error updating task embedding: {e}")
-            self.connection.rollback()
+            logger.error("Error updating task embedding: %s", e)
             return False
     
     def update_all_embeddings(self):
         """Generate embeddings for all tasks that don't have them"""
         try:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                "SELECT id, title, description FROM tasks WHERE embedding IS NULL"
-            )
-            tasks = cursor.fetchall()
-            
-            updated_count = 0
-            for task_id, title, description in tasks:
-                # Combine title and description for better embeddings
-                text = f"{title}. {description}" if description else title
-                embedding = self.generate_embedding(text)
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "SELECT id, title, description FROM tasks WHERE embedding IS NULL"
+                )
+                tasks = cursor.fetchall()
                 
-                if embedding:
-                    cursor.execute(
-                        "UPDATE tasks SET embedding = %s WHERE id = %s",
-                        (embedding, task_id)
-                    )
-                    updated_count += 1
+                # Combine title and description for better embeddings
+                texts = [
+                    f"{title}. {description}" if description else title
+                    for _, title, description in tasks
+                ]
+
+                # Fetch everything already cached in one round trip and only
+                # run the model on the misses
+                embeddings = cache_manager.mget_embeddings(texts)
+                misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+                encoded = self.generate_embeddings([texts[i] for i in misses])
+                fills = []
+                for i, embedding in zip(misses, encoded):
+                    if embedding is not None:
+                        embeddings[i] = embedding
+                        fills.append((texts[i], embedding))
+                cache_manager.mset_embeddings(fills)
+
+                rows = [
+                    (task_id, embedding)
+                    for (task_id, _, _), embedding in zip(tasks, embeddings)
+                    if embedding is not None
+                ]
+                self._bulk_update_embeddings(cursor, rows)
+                updated_count = len(rows)
             
-            self.connection.commit()
-            cursor.close()
-            print(f"Updated embeddings for {updated_count} tasks")
+            if updated_count:
+                cache_manager.invalidate_search_cache()
+            logger.info("Updated embeddings for %d tasks", updated_count)
             return updated_count
         except Exception as e:
-            print(f"Error updating embeddings: {e}")
-            self.connection.rollback()
+            logger.error("Error updating embeddings: %s", e)
             return 0
     
+    def _bulk_update_embeddings(self, cursor, rows):
+        """Write many (task_id, embedding) pairs without a round trip per row"""
+        if len(rows) <= COPY_THRESHOLD:
+            execute_values(
+                cursor,
+                """
+                UPDATE tasks AS t SET embedding = v.embedding
+                FROM (VALUES %s) AS v(id, embedding)
+                WHERE t.id = v.id
+                """,
+                rows,
+                template="(%s, %s::vector)",
+                page_size=1000
+            )
+            return
+
+        # Very large batches: stream into a temp table, then one joined UPDATE
+        buffer = io.StringIO()
+        for task_id, embedding in rows:
+            buffer.write(f"{task_id}\t[{','.join(map(str, embedding))}]\n")
+        buffer.seek(0)
+
+        cursor.execute("""
+            CREATE TEMP TABLE tmp_embeddings (id INTEGER, embedding vector(384))
+            ON COMMIT DROP
+        """)
+        cursor.copy_expert("COPY tmp_embeddings (id, embedding) FROM STDIN", buffer)
+        cursor.execute("""
+            UPDATE tasks AS t SET embedding = e.embedding
+            FROM tmp_embeddings AS e
+            WHERE t.id = e.id
+        """)
+    
+    def get_query_embedding(self, query):
+        """Get the embedding for a search query, encoding it only on a cache miss"""
+        embedding = cache_manager.get_query_embedding(query)
+        if embedding is None:
+            embedding = self.generate_embedding(query)
+            if embedding is not None:
+                cache_manager.set_query_embedding(query, embedding)
+        return embedding
+    
+    def _hydrate_ranking(self, ranking):
+        """Attach current task rows to a cached (id, similarity) ranking"""
+        if not ranking:
+            return []
+        
+        with self._cursor(autocommit=True) as cursor:
+            cursor.execute("EXECUTE vtasks(%s)", ([hit['id'] for hit in ranking],))
+            rows = {row['id']: row for row in orjson.loads(cursor.fetchone()[0])}
+        
+        # Tasks deleted since the ranking was cached are dropped
+        return [
+            {**rows[hit['id']], 'similarity': hit['similarity']}
+            for hit in ranking if hit['id'] in rows
+        ]
+    
     def vector_search(self, query, limit=5):
         """Perform vector similarity search"""
-        query_embedding = self.generate_embedding(query)
-        if not query_embedding:
+        filters = {'limit': limit}
+        ranking = cache_manager.get_search_results(query, filters)
+        if ranking is not None:
+            try:
+                return self._hydrate_ranking(ranking)
+            except Exception as e:
+                logger.error("Error loading cached search results: %s", e)
+                return []
+        
+        # A repeated query with different filters still skips the model
+        query_embedding = self.get_query_embedding(query)
+        if query_embedding is None:
             return []
         
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("""
-                SELECT id, title, description, status, 
-                       embedding <-> %s as distance
-                FROM tasks 
-                WHERE embedding IS NOT NULL
-                ORDER BY distance
-                LIMIT %s
-            """, (query_embedding, limit))
-            
-            results = cursor.fetchall()
-            cursor.close()
-            
-            # Convert to list of dictionaries
-            search_results = []
-            for row in results:
-                search_results.append({
-                    'id': row[0],
-                    'title': row[1],
-                    'description': row[2],
-                    'status': row[3],
-                    'similarity': 1 - row[4]  # Convert distance to similarity
-                })
+            with self._cursor(autocommit=True) as cursor:
+                if limit > HNSW_EF_SEARCH:
+                    # ef_search below the limit would cap how many rows HNSW
+                    # returns. Sent with the EXECUTE as one query string, which
+                    # Postgres runs as a single implicit transaction.
+                    ef_search = min(limit, HNSW_EF_SEARCH_MAX)
+                    cursor.execute(
+                        "SET LOCAL hnsw.ef_search = %s; EXECUTE vsearch(%s, %s)",
+                        (ef_search, query_embedding, limit)
+                    )
+                else:
+                    cursor.execute("EXECUTE vsearch(%s, %s)", (query_embedding, limit))
+                search_results = orjson.loads(cursor.fetchone()[0])
             
+            # Cache only the ranking; row contents are re-read on every hit
+            ranking = [
+                {'id': row['id'], 'similarity': row['similarity']}
+                for row in search_results
+            ]
+            cache_manager.set_search_results(query, ranking, filters)
             return search_results
         except Exception as e:
-            print(f"Error performing vector search: {e}")
+            logger.error("Error performing vector search: %s", e)
             return []
     
     def close_connection(self):
-        """Close database connection"""
-        if self.connection:
-            self.connection.close()
+        """Close all pooled database connections"""
+        if self.pool:
+            self.pool.closeall()
 
 def main():
     """Main function to test the vector search service"""
+    logging.basicConfig(
+        level=os.getenv('LOG_LEVEL', 'WARNING').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
     service = VectorSearchService()
     
     try: